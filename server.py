@@ -1,15 +1,18 @@
 import os
-import base64
-import json
-from fastapi import FastAPI, Request
-from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from fastapi import BackgroundTasks, FastAPI, Request
+from pydantic import BaseModel, ConfigDict
+from pydantic.dataclasses import dataclass
 from typing import List, Optional
-from github import Github
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import asyncio
+from cachetools import LRUCache, TTLCache
 import httpx
+import orjson
 import logging
 import sys
+import time
 
 # ------------------------------
 # Config
@@ -19,8 +22,35 @@ if not GITHUB_TOKEN:
     raise RuntimeError("Set the GITHUB_TOKEN environment variable")
 
 VALID_SECRET = "Ojal2"  # for local testing
-g = Github(GITHUB_TOKEN)
-app = FastAPI()
+GITHUB_API = "https://api.github.com"
+LICENSE_TEXT = "MIT License\n\nCopyright (c) ..."
+
+# Connection pool sized for bursts of concurrent uploads; short pool/connect
+# timeouts so a stuck upstream can't starve the pool.
+HTTP_LIMITS = httpx.Limits(max_connections=1000, max_keepalive_connections=100, keepalive_expiry=30.0)
+HTTP_TIMEOUT = httpx.Timeout(connect=5.0, read=30.0, write=30.0, pool=5.0)
+
+# Bound concurrent blob uploads to stay under GitHub's secondary rate limits
+GH_MAX_CONCURRENT = int(os.getenv("GH_MAX_CONCURRENT", "8"))
+GH_MAX_RETRIES = 5
+GH_MAX_BACKOFF = 60
+
+# Evaluation POST responses worth retrying; other 4xx fail fast
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+EVAL_MAX_BACKOFF = 60
+gh_semaphore = asyncio.Semaphore(GH_MAX_CONCURRENT)
+
+# path -> (etag, json body) for conditional GETs against the GitHub API, bounded LRU
+etag_cache = LRUCache(maxsize=1024)
+# task -> default branch, filled on first successful repo lookup
+default_branches = {}
+
+# (task, round, nonce) -> (repo_url, commit_sha, pages_url) so evaluator retries don't redo the commit
+nonce_cache = TTLCache(maxsize=10_000, ttl=3600)
+# (task, round, nonce) -> [lock, holders + waiters], see keyed_lock
+nonce_locks = {}
+# task -> [lock, holders + waiters] held while committing to that repo, see keyed_lock
+repo_locks = {}
 
 # ------------------------------
 # Logging
@@ -34,12 +64,16 @@ logging.basicConfig(
 # ------------------------------
 # Models
 # ------------------------------
-class Attachment(BaseModel):
+# Slotted, frozen dataclass: no per-instance __dict__ for requests with many attachments
+@dataclass(slots=True, frozen=True, config=ConfigDict(extra="ignore"))
+class Attachment:
     filename: str
     content: str
     mime_type: Optional[str] = "application/octet-stream"
 
 class RequestPayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     email: str
     secret: str
     task: str
@@ -50,83 +84,282 @@ class RequestPayload(BaseModel):
     evaluation_url: str
     attachments: List[Attachment] = []
 
+# Declared response type lets FastAPI serialize through pydantic-core instead of jsonable_encoder
+class EndpointResponse(BaseModel):
+    status: Optional[str] = None
+    repo_url: Optional[str] = None
+    commit_sha: Optional[str] = None
+    pages_url: Optional[str] = None
+    message: Optional[str] = None
+    error: Optional[str] = None
+
+# ------------------------------
+# Locks
+# ------------------------------
+@asynccontextmanager
+async def keyed_lock(locks: dict, key):
+    """Hold the asyncio.Lock for key. The entry is refcounted and only dropped once
+    nobody holds or waits on it, so later callers can't get a second lock for the same key."""
+    entry = locks.get(key)
+    if entry is None:
+        entry = locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del locks[key]
+
 # ------------------------------
 # GitHub Helper
 # ------------------------------
-def init_or_update_repo(task_name: str, round_index: int, brief: str, attachments: List[Attachment]):
-    user = g.get_user()
+async def cached_get(client: httpx.AsyncClient, path: str):
+    """GET a GitHub API path, revalidating with If-None-Match so unchanged
+    resources come back as a cheap 304 served from etag_cache.
+    Returns (status_code, json body or None on 404)."""
+    cached = etag_cache.get(path)
+    headers = {"If-None-Match": cached[0]} if cached else {}
+    r = await client.get(path, headers=headers)
+    if r.status_code == 304 and cached:
+        return 200, cached[1]
+    if r.status_code == 404:
+        etag_cache.pop(path, None)
+        return 404, None
+    r.raise_for_status()
+    data = r.json()
+    if "ETag" in r.headers:
+        etag_cache[path] = (r.headers["ETag"], data)
+    return r.status_code, data
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After header as seconds, from either delta-seconds or an HTTP-date."""
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
     try:
-        repo = user.get_repo(task_name)
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def rate_limit_wait(r: httpx.Response, default: float) -> Optional[float]:
+    """Seconds to wait before retrying if r is a GitHub rate-limit response, else None.
+    Plain 403s (bad credentials, missing permissions) are not rate limits, and a limit
+    that won't lift within GH_MAX_BACKOFF fails fast rather than sleeping on it."""
+    if r.status_code not in (403, 429):
+        return None
+    if "retry-after" in r.headers:
+        wait = parse_retry_after(r.headers["retry-after"])
+        if wait is None:
+            wait = default
+    elif r.headers.get("x-ratelimit-remaining") == "0":
+        reset = r.headers.get("x-ratelimit-reset")
+        wait = max(int(reset) - time.time(), 0) if reset and reset.isdigit() else default
+    elif "secondary rate limit" in r.text.lower():
+        # No timing headers: GitHub asks for at least a minute before retrying
+        wait = GH_MAX_BACKOFF
+    else:
+        return None
+    return wait if wait <= GH_MAX_BACKOFF else None
+
+async def create_blob(client: httpx.AsyncClient, repo_path: str, content: str, encoding: str) -> str:
+    # orjson encodes straight to bytes; httpx's json= goes through a str and then bytes,
+    # which doubles the copies of large base64 attachments
+    body = orjson.dumps({"content": content, "encoding": encoding})
+    delay = 1
+    for attempt in range(GH_MAX_RETRIES):
+        async with gh_semaphore:
+            r = await client.post(
+                f"/repos/{repo_path}/git/blobs", content=body, headers={"Content-Type": "application/json"})
+        wait = rate_limit_wait(r, delay)
+        if wait is None or attempt == GH_MAX_RETRIES - 1:
+            break
+        # Sleep outside the semaphore so a throttled upload doesn't hold a slot
+        logging.warning(f"⏳ GitHub rate limited blob upload ({r.status_code}), retrying in {wait:.0f}s")
+        await asyncio.sleep(wait)
+        delay *= 2
+    r.raise_for_status()
+    return r.json()["sha"]
+
+async def read_tree(client: httpx.AsyncClient, repo_path: str, tree_sha: str) -> dict:
+    # Trees are addressed by sha and never change, so there's nothing to revalidate; not cached
+    r = await client.get(f"/repos/{repo_path}/git/trees/{tree_sha}", params={"recursive": 1})
+    r.raise_for_status()
+    tree = r.json()
+    if tree.get("truncated"):
+        logging.warning(f"⚠️ Tree listing for {repo_path} is truncated; add/update detection may be incomplete")
+    return {entry["path"]: entry["sha"] for entry in tree["tree"]}
+
+async def resolve_repo(client: httpx.AsyncClient, repo_path: str, task_name: str, round_index: int) -> str:
+    """Find the repo (creating it in round 1) and cache its default branch."""
+    status, repo = await cached_get(client, f"/repos/{repo_path}")
+    if status == 200:
         logging.info(f"📂 Found existing repo: {task_name}")
-    except:
-        if round_index == 1:
-            logging.info(f"🆕 Creating repo: {task_name}")
-            repo = user.create_repo(task_name, private=False)
-        else:
-            raise RuntimeError(f"Repo {task_name} does not exist for round {round_index}")
+    elif round_index == 1:
+        logging.info(f"🆕 Creating repo: {task_name}")
+        # auto_init gives the repo a first commit so the Git Data API has a base tree
+        r = await client.post("/user/repos", json={"name": task_name, "private": False, "auto_init": True})
+        r.raise_for_status()
+        repo = r.json()
+    else:
+        raise RuntimeError(f"Repo {task_name} does not exist for round {round_index}")
+    default_branches[task_name] = repo["default_branch"]
+    return repo["default_branch"]
 
-    # Add/update files
-    for attach in attachments:
-        content = base64.b64decode(attach.content.encode())
-        try:
-            repo_file = repo.get_contents(attach.filename)
-            repo.update_file(repo_file.path, f"Update {attach.filename}", content, repo_file.sha)
-            logging.info(f"🔄 Updated file: {attach.filename}")
-        except:
-            repo.create_file(attach.filename, f"Add {attach.filename}", content)
-            logging.info(f"➕ Added file: {attach.filename}")
-
-    # Update README.md with brief
-    readme_content = f"# {task_name}\n\nBrief:\n{brief}\n\nUpdated: {datetime.utcnow().isoformat()}"
-    try:
-        readme_file = repo.get_contents("README.md")
-        repo.update_file(readme_file.path, "Update README.md", readme_content, readme_file.sha)
-        logging.info("📝 README.md updated.")
-    except:
-        repo.create_file("README.md", "Add README.md", readme_content)
-        logging.info("📝 README.md created.")
-
-    # Add MIT License if round 1
-    if round_index == 1:
-        license_text = "MIT License\n\nCopyright (c) ..."
-        try:
-            repo.create_file("LICENSE", "Add MIT License", license_text)
+async def init_or_update_repo(client: httpx.AsyncClient, login: str, task_name: str, round_index: int, brief: str, attachments: List[Attachment]):
+    repo_path = f"{login}/{task_name}"
+
+    if task_name in default_branches:
+        logging.info(f"📂 Found existing repo: {task_name}")
+    else:
+        await resolve_repo(client, repo_path, task_name, round_index)
+
+    # Serialize read-base -> commit -> update-ref per repo; a concurrent request on a stale
+    # base would make the ref update a non-fast-forward
+    async with keyed_lock(repo_locks, task_name):
+        # Base commit; its tree tells us which paths already exist
+        branch = default_branches[task_name]
+        status, branch_info = await cached_get(client, f"/repos/{repo_path}/branches/{branch}")
+        if status == 404:
+            # Cached branch is stale (repo deleted or branch renamed); look the repo up again
+            default_branches.pop(task_name, None)
+            branch = await resolve_repo(client, repo_path, task_name, round_index)
+            status, branch_info = await cached_get(client, f"/repos/{repo_path}/branches/{branch}")
+            if status == 404:
+                raise RuntimeError(f"Branch {branch} not found in {repo_path}")
+        base_commit = branch_info["commit"]
+        base_tree_sha = base_commit["commit"]["tree"]["sha"]
+
+        # Upload attachment blobs concurrently with the tree read; content is already base64 so it's forwarded as-is
+        existing, *shas = await asyncio.gather(
+            read_tree(client, repo_path, base_tree_sha),
+            *(create_blob(client, repo_path, attach.content, "base64") for attach in attachments),
+        )
+        # path -> tree entry, so a later write to the same path replaces the earlier one
+        elements = {}
+        for attach, sha in zip(attachments, shas):
+            elements[attach.filename] = {"path": attach.filename, "mode": "100644", "type": "blob", "sha": sha}
+        for attach in attachments:
+            if attach.filename in existing:
+                logging.info(f"🔄 Updated file: {attach.filename}")
+            else:
+                logging.info(f"➕ Added file: {attach.filename}")
+
+        # README.md with brief; UTF-8 text goes inline in the tree, no blob POST needed
+        readme_content = f"# {task_name}\n\nBrief:\n{brief}\n\nUpdated: {datetime.utcnow().isoformat()}"
+        elements["README.md"] = {"path": "README.md", "mode": "100644", "type": "blob", "content": readme_content}
+        logging.info("📝 README.md updated." if "README.md" in existing else "📝 README.md created.")
+
+        # MIT License if round 1, without overwriting one that's already there
+        if round_index == 1 and "LICENSE" not in existing:
+            elements["LICENSE"] = {"path": "LICENSE", "mode": "100644", "type": "blob", "content": LICENSE_TEXT}
             logging.info("📄 LICENSE added.")
-        except:
-            pass
 
-    commit_sha = repo.get_commits()[0].sha
-    pages_url = f"https://{user.login}.github.io/{task_name}/"
-    return repo.html_url, commit_sha, pages_url
+        # Build every file into one tree / one commit
+        r = await client.post(f"/repos/{repo_path}/git/trees", json={
+            "base_tree": base_tree_sha,
+            "tree": list(elements.values()),
+        })
+        r.raise_for_status()
+        tree_sha = r.json()["sha"]
+        r = await client.post(f"/repos/{repo_path}/git/commits", json={
+            "message": f"Round {round_index}: update {task_name}",
+            "tree": tree_sha,
+            "parents": [base_commit["sha"]],
+        })
+        r.raise_for_status()
+        commit_sha = r.json()["sha"]
+        r = await client.patch(f"/repos/{repo_path}/git/refs/heads/{branch}", json={"sha": commit_sha})
+        r.raise_for_status()
+        logging.info(f"✅ Committed {len(elements)} file(s) in {commit_sha}")
+
+    pages_url = f"https://{login}.github.io/{task_name}/"
+    return f"https://github.com/{repo_path}", commit_sha, pages_url
 
 # ------------------------------
 # Async Evaluation POST
 # ------------------------------
-async def post_evaluation_async(url, payload):
-    try:
-        async with httpx.AsyncClient(timeout=10) as client:
+async def post_evaluation_async(url, payload, client: httpx.AsyncClient, max_retries: int = 5):
+    delay = 1
+    for attempt in range(1, max_retries + 1):
+        try:
             r = await client.post(url, json=payload)
-            if r.status_code == 200:
+            if r.status_code in (200, 201, 204):
                 logging.info(f"✅ Successfully posted evaluation to {url}")
-            else:
-                logging.warning(f"⚠️ Evaluation POST returned {r.status_code}")
-    except Exception as e:
-        logging.error(f"❌ Failed to POST evaluation: {e}")
+                return True
+            if r.status_code not in RETRYABLE_STATUS:
+                logging.warning(f"⚠️ Evaluation POST returned {r.status_code}, not retrying")
+                return False
+            logging.warning(f"⚠️ Evaluation POST returned {r.status_code} (attempt {attempt}/{max_retries})")
+            retry_after = parse_retry_after(r.headers.get("Retry-After"))
+        except httpx.HTTPError as e:
+            logging.warning(f"⚠️ Evaluation POST failed: {e} (attempt {attempt}/{max_retries})")
+            retry_after = None
+        except Exception as e:
+            # e.g. httpx.InvalidURL: not transient, and must not escape the background task
+            logging.error(f"❌ Failed to POST evaluation: {e}")
+            return False
+        if attempt < max_retries:
+            # Honor the server's Retry-After when it gives one (capped), else back off exponentially
+            wait = min(retry_after, EVAL_MAX_BACKOFF) if retry_after is not None else delay
+            await asyncio.sleep(wait)
+            delay *= 2
+    logging.error(f"❌ Failed to POST evaluation to {url} after {max_retries} attempts")
+    return False
+
+# ------------------------------
+# App / Lifespan
+# ------------------------------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.github = httpx.AsyncClient(
+        base_url=GITHUB_API,
+        headers={
+            "Authorization": f"Bearer {GITHUB_TOKEN}",
+            "Accept": "application/vnd.github+json",
+        },
+        http2=True,
+        limits=HTTP_LIMITS,
+        timeout=HTTP_TIMEOUT,
+    )
+    _, user = await cached_get(app.state.github, "/user")
+    app.state.gh_login = user["login"]
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=HTTP_LIMITS,
+        timeout=HTTP_TIMEOUT,
+    )
+    logging.info("🚀 Server startup complete! Your API is running.")
+    logging.info("📘 Visit http://127.0.0.1:8000/docs for interactive API docs.")
+    yield
+    await app.state.http.aclose()
+    await app.state.github.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 # ------------------------------
 # API Endpoint
 # ------------------------------
-@app.post("/api-endpoint")
-async def handle_request(request: Request):
-    payload_json = await request.json()
-    payload = RequestPayload(**payload_json)
+@app.post("/api-endpoint", response_model_exclude_none=True)
+async def handle_request(request: Request, background_tasks: BackgroundTasks) -> EndpointResponse:
+    # Validate straight from the raw body in pydantic-core, skipping the dict round-trip
+    payload = RequestPayload.model_validate_json(await request.body())
 
     # Verify secret
     if payload.secret != VALID_SECRET:
-        return {"error": "Invalid secret"}
+        return EndpointResponse(error="Invalid secret")
 
-    # Init or update repo
-    repo_url, commit_sha, pages_url = init_or_update_repo(payload.task, payload.round, payload.brief, payload.attachments)
+    # Init or update repo (once per task/round/nonce; concurrent retries wait on the same lock)
+    key = (payload.task, payload.round, payload.nonce)
+    async with keyed_lock(nonce_locks, key):
+        if key in nonce_cache:
+            logging.info(f"♻️ Reusing result for retried nonce {payload.nonce}")
+        else:
+            nonce_cache[key] = await init_or_update_repo(
+                request.app.state.github, request.app.state.gh_login, payload.task, payload.round, payload.brief, payload.attachments)
+        repo_url, commit_sha, pages_url = nonce_cache[key]
 
     # Prepare evaluation payload
     eval_payload = {
@@ -139,22 +372,14 @@ async def handle_request(request: Request):
         "pages_url": pages_url
     }
 
-    # Fire POST in background, don't block response
-    asyncio.create_task(post_evaluation_async(payload.evaluation_url, eval_payload))
+    # Send POST after the response goes out, don't block it
+    background_tasks.add_task(post_evaluation_async, payload.evaluation_url, eval_payload, request.app.state.http)
 
     # Return immediately
-    return {
-        "status": "ok",
-        "repo_url": repo_url,
-        "commit_sha": commit_sha,
-        "pages_url": pages_url,
-        "message": "Repo updated! Evaluation POST sent in background."
-    }
-
-# ------------------------------
-# Startup Logging
-# ------------------------------
-@app.on_event("startup")
-async def startup_event():
-    logging.info("🚀 Server startup complete! Your API is running.")
-    logging.info("📘 Visit http://127.0.0.1:8000/docs for interactive API docs.")
+    return EndpointResponse(
+        status="ok",
+        repo_url=repo_url,
+        commit_sha=commit_sha,
+        pages_url=pages_url,
+        message="Repo updated! Evaluation POST sent in background.",
+    )